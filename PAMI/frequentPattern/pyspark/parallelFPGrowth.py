@@ -55,51 +55,62 @@ Copyright (C)  2021 Rage Uday Kiran
 
 
 # from pyspark import SparkConf, SparkContext
+from array import array
 from collections import defaultdict
+from heapq import heappush, heappop
+from math import log
 from PAMI.frequentPattern.pyspark import abstract as _ab
 from operator import add
 from pyspark import SparkConf as _SparkConf, SparkContext as _SparkContext
 from deprecated import deprecated
 
 
-class Node:
-    """
-    :Attribute:
-        item : int
-            Storing item of a node
-        count : int
-            To maintain the support count of node
-        children : dict
-            To maintain the children of node
-        prefix : list
-            To maintain the prefix of node
-    """
-    def __init__(self, item, prefix):
-        self.item = item
-        self.count = 0
-        self.children = {}
-        self.prefix = prefix
-
-
 class Tree:
     """
+    FP-tree stored as flat arrays indexed by node id. Node 0 is the root, and every node is
+    appended after its parent, so a parent always has a smaller id than its children.
+
     :Attribute:
-        root : Node
-            The first node of the tree set to Null
-        nodeLink : dict
-            Store nodes that have the same item
+        item : array
+            Item of every node, with the typecode given to the constructor. The root holds 0
+        parent : array
+            Id of the parent of every node
+        count : array
+            Support count of every node
+        nextLink : array
+            Id of the next node holding the same item, -1 at the end of the node link
+        headOfLink : dict
+            Id of the first node of the node link of every item
+        children : dict
+            Id of the child of a node for an item, keyed by (parent id, item)
+        itemCount : dict
+            Support count of every item in the tree
     :Methods:
 
         addTransaction(transaction, count)
             Create tree from transaction and count
-        addNodeToNodeLink(node)
-            Add nodes that have the same item to self.nodeLink
-        generateConditionalTree(item)
-            Create conditional pattern base of item
+        addNode(item, parent)
+            Append a node to the tree and link it into the node link of its item
+        generateConditionalTree(item, minSup)
+            Create conditional tree of item from its frequent conditional pattern base
+        merge(tree)
+            Merge another tree into this tree
+        fromArrays(item, parent, count)
+            Rebuild a tree from its item, parent and count arrays
     """
-    def __init__(self):
-        self.root = Node(None, [])
-        self.nodeLink = {}
+    __slots__ = ('item', 'parent', 'count', 'nextLink', 'headOfLink', 'children', 'itemCount')
+
+    def __init__(self, typecode='i'):
+        """
+        :param typecode: array typecode of the items, 'H' when every item rank fits in 16 bits
+        :type typecode: str
+        """
+        self.item = array(typecode, [0])
+        self.parent = array('i', [-1])
+        self.count = array('q', [0])
+        self.nextLink = array('i', [-1])
+        self.headOfLink = {}
+        self.children = {}
         self.itemCount = defaultdict(int)
 
 
@@ -111,40 +122,122 @@ class Tree:
         :param count: Number of nodes
         :type count: int
         """
-        current = self.root
+        current = 0
+        counts = self.count
+        children = self.children
+        itemCount = self.itemCount
         for item in transaction:
-            if item not in current.children:
-                current.children[item] = Node(item, transaction[0:transaction.index(item)])
-                current.children[item].count += count
-                self.addNodeToNodeLink(current.children[item])
-            else:
-                current.children[item].count += count
-            self.itemCount[item] += count
-            current = current.children[item]
+            child = children.get((current, item))
+            if child is None:
+                child = self.addNode(item, current)
+            counts[child] += count
+            itemCount[item] += count
+            current = child
 
 
-    def addNodeToNodeLink(self, node):
+    def addNode(self, item, parent):
         """
-        Add node to self.nodeLink
-        :param node: Node to add
-        :type node: Node
+        Append a node to the tree and link it into the node link of its item
+        :param item: item of the node
+        :type item: int
+        :param parent: id of the parent node
+        :type parent: int
+        :return: id of the new node
         """
-        if node.item not in self.nodeLink:
-            self.nodeLink[node.item] = [node]
-        else:
-            self.nodeLink[node.item].append(node)
+        node = len(self.item)
+        self.item.append(item)
+        self.parent.append(parent)
+        self.count.append(0)
+        self.nextLink.append(self.headOfLink.get(item, -1))
+        self.headOfLink[item] = node
+        self.children[(parent, item)] = node
+        return node
 
 
-    def generateConditionalTree(self, item):
+    def generateConditionalTree(self, item, minSup=0):
         """
         Generate conditional tree based on item
         :param item: Item to be considered as a condition
-        :type item: str or int
+        :type item: int
+        :param minSup: Items whose support in the conditional pattern base is below minSup are left out of the tree
+        :type minSup: int or float
+        :return: Tree
+        """
+        items = self.item
+        parents = self.parent
+        counts = self.count
+        nextLink = self.nextLink
+        paths = []
+        support = defaultdict(int)
+        node = self.headOfLink[item]
+        while node != -1:
+            path = []
+            count = counts[node]
+            parent = parents[node]
+            while parent != 0:
+                path.append(items[parent])
+                support[items[parent]] += count
+                parent = parents[parent]
+            paths.append((path, count))
+            node = nextLink[node]
+        tree = Tree(items.typecode)
+        for path, count in paths:
+            tree.addTransaction([i for i in reversed(path) if support[i] >= minSup], count)
+        return tree
+
+    def merge(self, tree):
+        """
+        Merge another tree into this tree
+        :param tree: Tree to merge
+        :type tree: Tree
+        :return: Tree
+        """
+        counts = self.count
+        children = self.children
+        itemCount = self.itemCount
+        nodeMap = array('i', [0]) * len(tree.item)
+        for node in range(1, len(tree.item)):
+            item = tree.item[node]
+            parent = nodeMap[tree.parent[node]]
+            child = children.get((parent, item))
+            if child is None:
+                child = self.addNode(item, parent)
+            counts[child] += tree.count[node]
+            itemCount[item] += tree.count[node]
+            nodeMap[node] = child
+        return self
+
+    def __reduce__(self):
+        """
+        Pickle only the item, parent and count arrays, the rest of the tree is rebuilt from them
+        """
+        return Tree.fromArrays, (self.item, self.parent, self.count)
+
+    @classmethod
+    def fromArrays(cls, item, parent, count):
+        """
+        Rebuild a tree from its item, parent and count arrays
+        :param item: item of every node
+        :type item: array
+        :param parent: id of the parent of every node
+        :type parent: array
+        :param count: support count of every node
+        :type count: array
         :return: Tree
         """
-        tree = Tree()
-        for node in self.nodeLink[item]:
-            tree.addTransaction(node.prefix, node.count)
+        tree = cls(item.typecode)
+        tree.item = item
+        tree.parent = parent
+        tree.count = count
+        tree.nextLink = array('i', [-1]) * len(item)
+        headOfLink = tree.headOfLink
+        children = tree.children
+        itemCount = tree.itemCount
+        for node in range(1, len(item)):
+            tree.nextLink[node] = headOfLink.get(item[node], -1)
+            headOfLink[item[node]] = node
+            children[(parent[node], item[node])] = node
+            itemCount[item[node]] += count[node]
         return tree
 
 
@@ -167,6 +260,8 @@ class parallelFPGrowth(_ab._frequentPatterns):
                    This variable is used to distinguish items from one another in a transaction. The default seperator is tab space. However, the users can override their default separator.
     :param  numPartitions: int :
                    The number of partitions. On each worker node, an executor process is started and this process performs processing.The processing unit of worker node is partition
+    :param  master: str :
+                   The Spark master URL to connect to, for example spark://host:7077 or yarn. The default is local[*], which runs on all the cores of the local machine.
 
 
     :Attributes:
@@ -249,6 +344,9 @@ class parallelFPGrowth(_ab._frequentPatterns):
     _endTime = float()
     _finalPatterns = dict()
     _FPList = list()
+    _partMap = list()
+    _rankType = 'i'
+    _master = None
     _iFile = " "
     _oFile = " "
     _sep = " "
@@ -257,8 +355,9 @@ class parallelFPGrowth(_ab._frequentPatterns):
     _lno = int()
 
 
-    def __init__(self, iFile, minSup, numWorkers, sep='\t'):
+    def __init__(self, iFile, minSup, numWorkers, sep='\t', master=None):
         super().__init__(iFile, minSup, int(numWorkers), sep)
+        self._master = master
 
     @deprecated("It is recommended to use 'mine()' instead of 'startMine()' for mining process. Starting from January 2025, 'startMine()' will be completely terminated.")
     def startMine(self):
@@ -274,33 +373,52 @@ class parallelFPGrowth(_ab._frequentPatterns):
 
         self._startTime = _ab._time.time()
 
-        conf = _SparkConf().setAppName("Parallel FPGrowth").setMaster("local[*]")
+        conf = _SparkConf().setAppName("Parallel FPGrowth").setMaster(self._master or "local[*]")\
+            .set("spark.serializer", "org.apache.spark.serializer.KryoSerializer")\
+            .set("spark.default.parallelism", str(self._numPartitions))\
+            .set("spark.rdd.compress", "true")
         sc = _SparkContext(conf=conf)
 
         rdd = sc.textFile(self._iFile, self._numPartitions)\
             .map(lambda x: x.rstrip().split(self._sep))\
             .persist()
 
-        self._lno = rdd.count()
+        # a single pass counts both the items and the transactions, the latter under the key None
+        counts = rdd.flatMap(lambda trans: [(None, 1)] + [(item, 1) for item in trans])\
+            .reduceByKey(add)\
+            .persist()
+
+        lno = counts.lookup(None)
+        self._lno = lno[0] if lno else 0
         self._minSup = self._convert(self._minSup)
+        minSup = self._minSup
 
-        freqItems = rdd.flatMap(lambda trans: [(item, 1) for item in trans])\
-            .reduceByKey(add)\
-            .filter(lambda x: x[1] >= self._minSup)\
-            .sortBy(lambda x: x[1], ascending=False)\
-            .collect()
-        self._finalPatterns = dict(freqItems)
+        freqItems = counts.filter(lambda x: x[0] is not None and x[1] >= minSup).collect()
+        freqItems.sort(key=lambda x: x[1], reverse=True)
+        counts.unpersist()
+        self._finalPatterns = {(item,): support for (item, support) in freqItems}
         self._FPList = [x[0] for x in freqItems]
         rank = dict([(item, index) for (index, item) in enumerate(self._FPList)])
-
-        workByPartition = rdd.flatMap(lambda x: self.genCondTransaction(x, rank)).groupByKey()
-
-        trees = workByPartition.foldByKey(Tree(), lambda tree, data: self.buildTree(tree, data))
+        self._rankType = 'H' if len(self._FPList) < 2 ** 16 else 'i'
+        rankType = self._rankType
+        self._partMap = self._assignPartitions(freqItems)
+
+        rankBC = sc.broadcast(rank)
+        partMapBC = sc.broadcast(self._partMap)
+        numPartitions = self._numPartitions
+        trees = rdd.flatMap(lambda x: parallelFPGrowth.genCondTransaction(x, rankBC.value, partMapBC.value, rankType))\
+            .aggregateByKey(Tree(rankType), parallelFPGrowth.buildTree, lambda tree1, tree2: tree1.merge(tree2),
+                            numPartitions, partitionFunc=lambda partition: partition)
         freqPatterns = trees.flatMap(lambda tree_tuple: self.genAllFrequentPatterns(tree_tuple))
-        result = freqPatterns.map(lambda ranks_count: (tuple([self._FPList[z] for z in ranks_count[0]]), ranks_count[1]))\
-            .collect()
+        fpListBC = sc.broadcast(self._FPList)
+        result = freqPatterns.map(lambda ranks_count: (tuple([fpListBC.value[z] for z in ranks_count[0]]), ranks_count[1]))\
+            .collectAsMap()
+        rdd.unpersist()
+        rankBC.unpersist()
+        partMapBC.unpersist()
+        fpListBC.unpersist()
 
-        self._finalPatterns.update(dict(result))
+        self._finalPatterns.update(result)
 
         self._endTime = _ab._time.time()
         process = _ab._psutil.Process(_ab._os.getpid())
@@ -311,45 +429,70 @@ class parallelFPGrowth(_ab._frequentPatterns):
         print("Frequent patterns were generated successfully using Parallel FPGrowth algorithm")
 
 
-    def getPartitionId(self, value):
+    def _assignPartitions(self, freqItems):
+        """
+        Assign the ranked items to partitions so that the estimated mining work is balanced.
+        Items are taken in decreasing order of support * log(support) and each one goes to the
+        partition with the least work assigned so far (longest processing time first)
+        :param freqItems: frequent items and their supports, in rank order
+        :type freqItems: list
+        :return: list mapping each rank to its partition id
+        """
+        partMap = [0] * len(freqItems)
+        loads = [(0, partition) for partition in range(self._numPartitions)]
+        costs = [support * log(support + 1) for (item, support) in freqItems]
+        for index in sorted(range(len(freqItems)), key=lambda x: costs[x], reverse=True):
+            load, partition = heappop(loads)
+            partMap[index] = partition
+            heappush(loads, (load + costs[index], partition))
+        return partMap
+
+    @staticmethod
+    def getPartitionId(value, partMap):
         """
         Get partition id of item
         :param value: value to get partition id
         :type value: int
+        :param partMap: partition id of every item rank
+        :type partMap: list
         :return: integer
         """
-        return value % self._numPartitions
+        return partMap[value]
 
-    def genCondTransaction(self, trans, rank):
+    @staticmethod
+    def genCondTransaction(trans, rank, partMap, typecode='i'):
         """
         Generate conditional transactions from transaction
         :param trans : transactions to generate conditional transactions
         :type trans: list
         :param rank: rank of conditional transactions to generate conditional transactions
         :type rank: dict
+        :param partMap: partition id of every item rank
+        :type partMap: list
+        :param typecode: array typecode of the item ranks
+        :type typecode: str
         :return: list
         """
-        newTrans = [rank[item] for item in trans if item in rank.keys()]
-        newTrans = sorted(newTrans)
+        newTrans = [rank[item] for item in trans if item in rank]
+        newTrans = array(typecode, sorted(newTrans))
         condTrans = {}
-        for i in reversed(newTrans):
-            partition = self.getPartitionId(i)
+        for k, i in enumerate(reversed(newTrans)):
+            partition = parallelFPGrowth.getPartitionId(i, partMap)
             if partition not in condTrans:
-                condTrans[partition] = newTrans[:newTrans.index(i)+1]
+                condTrans[partition] = newTrans[:len(newTrans) - k]
         return [x for x in condTrans.items()]
 
     @staticmethod
-    def buildTree(tree, data):
+    def buildTree(tree, trans):
         """
-        Build tree from data
+        Add a conditional transaction to tree
         :param tree: tree to build
         :type tree: Tree
-        :param data: data to build
-        :type data: list
+        :param trans: conditional transaction to add
+        :type trans: array
         :return: tree
         """
-        for trans in data:
-            tree.addTransaction(trans, 1)
+        tree.addTransaction(trans, 1)
         return tree
 
     def genAllFrequentPatterns(self, tree_tuple):
@@ -363,7 +506,7 @@ class parallelFPGrowth(_ab._frequentPatterns):
         itemList = [x[0] for x in itemList]
         freqPatterns = {}
         for item in itemList:
-            if self.getPartitionId(item) == tree_tuple[0]:
+            if self.getPartitionId(item, self._partMap) == tree_tuple[0]:
                 freqPatterns.update(self.genFreqPatterns(item, [item], tree_tuple[1]))
         return freqPatterns.items()
 
@@ -376,21 +519,18 @@ class parallelFPGrowth(_ab._frequentPatterns):
         :type prefix: str
         :param tree: tree to generate patterns
         :type tree: Tree
-        :return:
+        :return: dict
         """
-        condTree = tree.generateConditionalTree(item)
+        minSup = self._minSup
         freqPatterns = {}
-        freqItems = {}
-        for i in condTree.nodeLink.keys():
-            freqItems[i] = 0
-            for node in condTree.nodeLink[i]:
-                freqItems[i] += node.count
-        freqItems = {key: value for key, value in freqItems.items() if value >= self._minSup}
-
-        for i in freqItems:
-            pattern = prefix + [i]
-            freqPatterns[tuple(pattern)] = freqItems[i]
-            freqPatterns.update(self.genFreqPatterns(i, pattern, condTree))
+        stack = [(item, prefix, tree)]
+        while stack:
+            item, prefix, tree = stack.pop()
+            condTree = tree.generateConditionalTree(item, minSup)
+            for i, support in condTree.itemCount.items():
+                pattern = prefix + [i]
+                freqPatterns[tuple(pattern)] = support
+                stack.append((i, pattern, condTree))
         return freqPatterns
 
     def getMemoryUSS(self):
@@ -427,11 +567,8 @@ class parallelFPGrowth(_ab._frequentPatterns):
         :rtype: pd.DataFrame
         """
 
-        dataFrame = {}
-        data = []
-        for a, b in self._finalPatterns.items():
-            data.append([a, b])
-            dataFrame = _ab._pd.DataFrame(data, columns=['Patterns', 'Support'])
+        data = [[" ".join(a), b] for a, b in self._finalPatterns.items()]
+        dataFrame = _ab._pd.DataFrame(data, columns=['Patterns', 'Support'])
         return dataFrame
 
     def save(self, outFile):
@@ -441,16 +578,8 @@ class parallelFPGrowth(_ab._frequentPatterns):
         :type outFile: csvfile
         """
         self._oFile = outFile
-        writer = open(self._oFile, 'w+')
-        for x, y in self._finalPatterns.items():
-            if type(x) == tuple:
-                pattern = ""
-                for item in x:
-                    pattern = pattern + str(item) + " "
-                s1 = pattern + ":" + str(y)
-            else:
-                s1 = str(x) + ":" + str(y)
-            writer.write("%s \n" % s1)
+        with open(self._oFile, 'w', buffering=1 << 20) as writer:
+            writer.writelines("%s:%s\n" % ('\t'.join(x), y) for x, y in self._finalPatterns.items())
 
     def getPatterns(self):
         """